@@ -20,15 +20,24 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
+import pyarrow as pa
 from pycoingecko import CoinGeckoAPI
 from datetime import datetime, timezone
 from google.cloud import bigquery
 from google.oauth2 import service_account
 import google.api_core.exceptions
+from google.api_core.retry import Retry
 from typing import Dict, Any, Tuple, List
 import re
 import bcrypt
 import uuid # ★ 取引ID生成のために追加
+import hmac
+import hashlib
+import secrets
+import os
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 # === 2. 定数・グローバル設定 ===
 # --- BigQuery関連 ---
@@ -41,11 +50,14 @@ TABLE_USERS_FULL_ID = f"{PROJECT_ID}.{DATASET_ID}.{TABLE_USERS}"
 TABLE_TRANSACTIONS_FULL_ID = f"{PROJECT_ID}.{DATASET_ID}.{TABLE_TRANSACTIONS}"
 TABLE_WATCHLIST_FULL_ID = f"{PROJECT_ID}.{DATASET_ID}.{TABLE_WATCHLIST}"
 
+# ストリーミング挿入の一時的なエラー(503等)は指数バックオフで再試行する
+BIGQUERY_INSERT_RETRY = Retry(initial=0.1, maximum=2.0, multiplier=2.0, deadline=10.0)
 BIGQUERY_SCHEMA_USERS = [
     bigquery.SchemaField("user_id", "STRING", mode="REQUIRED"),
     bigquery.SchemaField("password_hash", "STRING", mode="REQUIRED"),
     bigquery.SchemaField("created_at", "TIMESTAMP", mode="REQUIRED"),
 ]
+BIGQUERY_CLUSTERING_USERS = ["user_id"]
 # ★★★ スキーマ定義の変更 ★★★
 BIGQUERY_SCHEMA_TRANSACTIONS = [
     bigquery.SchemaField("transaction_id", "STRING", mode="REQUIRED"), # ★取引IDを追加
@@ -61,6 +73,26 @@ BIGQUERY_SCHEMA_TRANSACTIONS = [
     bigquery.SchemaField("total_jpy", "FLOAT64", mode="REQUIRED"),
 ]
 # ★★★ ここまで ★★★
+# 新規作成するテーブルは取引日で月次パーティション分割し、ユーザー・コイン・取引所単位でクラスタリングする (既存テーブルは移行しない)
+BIGQUERY_PARTITIONING_TRANSACTIONS = bigquery.TimePartitioning(type_=bigquery.TimePartitioningType.MONTH, field="transaction_date")
+BIGQUERY_CLUSTERING_TRANSACTIONS = ["user_id", "coin_id", "exchange"]
+# 取引IDによる更新・削除のSQLは一度だけ組み立て、毎回同一のクエリ文字列(パラメータのみ変化)で実行する
+DELETE_TRANSACTION_SQL = f"""
+DELETE FROM `{TABLE_TRANSACTIONS_FULL_ID}`
+WHERE user_id = @user_id AND transaction_id = @transaction_id
+"""
+UPDATE_TRANSACTION_SQL = f"""
+UPDATE `{TABLE_TRANSACTIONS_FULL_ID}`
+SET
+    transaction_date = @transaction_date,
+    exchange = @exchange,
+    quantity = @quantity,
+    price_jpy = @price_jpy,
+    fee_jpy = @fee_jpy,
+    total_jpy = @total_jpy
+WHERE
+    user_id = @user_id AND transaction_id = @transaction_id
+"""
 BIGQUERY_SCHEMA_WATCHLIST = [
     bigquery.SchemaField("user_id", "STRING", mode="REQUIRED"),
     bigquery.SchemaField("coin_id", "STRING", mode="REQUIRED"),
@@ -74,17 +106,47 @@ COLUMN_NAME_MAP_JA = {
     'price_jpy': '価格(JPY)', 'fee_jpy': '手数料(JPY)', 'total_jpy': '合計(JPY)', 
     'coin_id': 'コインID'
 }
+# 画面で使う列だけを取得する (user_idは絞り込み条件、total_jpyは数量×価格で再計算できるため不要)
+TRANSACTION_SELECT_COLUMNS = ['transaction_id', 'transaction_date', 'coin_id', 'coin_name', 'exchange', 'transaction_type', 'quantity', 'price_jpy', 'fee_jpy']
+TRANSACTION_CATEGORY_COLUMNS = ['coin_id', 'coin_name', 'exchange', 'transaction_type']
+
+# --- 認証関連 ---
+BCRYPT_ROUNDS = 10
+BCRYPT_LEGACY_ROUNDS = 12 # 再ハッシュ移行前の既存アカウントのコスト
+BCRYPT_SALT_PREFIX_LEN = 29 # "$2b$12$" + 22文字のソルト
+PASSWORD_VERIFY_CACHE_SIZE = 1024
+USER_ID_PATTERN = re.compile(r'[A-Za-z0-9_.+\-@]{3,254}') # メールアドレスまたは英数字・記号(._+-@)のID
+BCRYPT_COST_PATTERN = re.compile(r'\$2[aby]\$(\d\d)\$')
+
+# --- CoinGecko API関連 ---
+# プロセス再起動後もレート制限のあるAPIを叩き直さないよう、応答をディスクにも保存する
+API_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache')
+# メモリ上のキャッシュはディスク上の応答から作られるため、両者のTTLの合計がデータの最大鮮度になる
+MARKET_DATA_MAX_AGE = 300
+EXCHANGE_RATE_MAX_AGE = 3600 # 法定通貨間のレートは短時間ではほぼ動かない
+MEMORY_CACHE_TTL_MARKETS = 120
+MEMORY_CACHE_TTL_PRICE = 1800
+API_CACHE_TTL_MARKETS = MARKET_DATA_MAX_AGE - MEMORY_CACHE_TTL_MARKETS
+API_CACHE_TTL_PRICE = EXCHANGE_RATE_MAX_AGE - MEMORY_CACHE_TTL_PRICE
 
 # --- アプリケーションUI関連 ---
 CURRENCY_SYMBOLS = {'jpy': '¥', 'usd': '$'}
 TRANSACTION_TYPES_BUY = ['購入', '調整（増）']
 TRANSACTION_TYPES_SELL = ['売却', '調整（減）']
+TRANSACTION_TYPE_SIGNS = {**dict.fromkeys(TRANSACTION_TYPES_BUY, 1.0), **dict.fromkeys(TRANSACTION_TYPES_SELL, -1.0)}
 EXCHANGES_ORDERED = ['SBIVC', 'BITPOINT', 'Binance', 'bitbank', 'GMOコイン', 'Bybit']
 COIN_COLORS = {
     "Bitcoin": "#F7931A", "Ethereum": "#627EEA", "Solana": "#9945FF", "XRP": "#00AAE4",
     "Tether": "#50AF95", "BNB": "#F3BA2F", "USD Coin": "#2775CA", "Dogecoin": "#C3A634",
     "Cardano": "#0033AD", "その他": "#D3D3D3"
 }
+MIDNIGHT = datetime.min.time()
+ZERO_DECIMALS_PATTERN = re.compile(r'\.0+$')
+TRAILING_ZEROS_PATTERN = re.compile(r'(\.\d*?[1-9])0+$')
+PENDING_TRANSACTIONS_FLUSH_SIZE = 50
+TRANSACTION_HISTORY_PAGE_SIZE = 25
+MARKET_CAP_RANK_LIMIT = 100
+MARKET_CAP_RANKS = [str(i) for i in range(1, MARKET_CAP_RANK_LIMIT + 1)]
 
 # --- CSSスタイル ---
 BLACK_THEME_CSS = """
@@ -122,19 +184,56 @@ def get_bigquery_client() -> bigquery.Client | None:
         st.error("GCPサービスアカウントの認証情報が設定されていません。")
         return None
 
-cg_client = CoinGeckoAPI()
+@st.cache_resource
+def get_coingecko_client() -> CoinGeckoAPI:
+    # 再実行ごとにHTTPセッションを作り直さず、接続をプロセス内で使い回す
+    return CoinGeckoAPI()
+
+@st.cache_resource
+def get_initialized_tables() -> set:
+    return set()
+
+@st.cache_resource
+def get_password_cache_secret() -> bytes:
+    return secrets.token_bytes(32)
+
+@st.cache_resource
+def get_dummy_password_hash() -> bytes:
+    # 未移行アカウントと応答時間が揃うよう、移行完了までは旧コストでダミーハッシュを作る
+    return bcrypt.hashpw(secrets.token_bytes(16), bcrypt.gensalt(rounds=BCRYPT_LEGACY_ROUNDS))
+
+@st.cache_resource
+def get_background_executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=2)
+
+cg_client = get_coingecko_client()
 bq_client = get_bigquery_client()
 
 # === 4. 認証関連関数 ===
 def hash_password(password: str) -> bytes:
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
-
-def verify_password(plain_password: str, hashed_password: bytes) -> bool:
-    return bcrypt.checkpw(plain_password.encode('utf-8'), hashed_password)
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=BCRYPT_ROUNDS))
+
+def verify_password(user_id: str, plain_password: str, hashed_password: bytes) -> bool:
+    # bcrypt形式でないハッシュはKDFを回さずに即座に不一致とする
+    if not BCRYPT_COST_PATTERN.match(hashed_password.decode('utf-8', 'replace')): return False
+    # 同一セッション内で同じ(ユーザー, パスワード, ハッシュ)の組を再検証する際はbcryptを省略する
+    # キーは平文ではなくHMAC値を使い、ログアウト時にsession_stateごと破棄される
+    cache = st.session_state.setdefault('password_verify_cache', {})
+    cache_key = hmac.new(
+        get_password_cache_secret(),
+        b'\0'.join([user_id.encode('utf-8'), plain_password.encode('utf-8'), hashed_password[:BCRYPT_SALT_PREFIX_LEN]]),
+        hashlib.sha256
+    ).digest()
+    if cache_key in cache: return True
+    # 不一致の結果は記録しない (失敗の再試行が高速化すると、応答時間からアカウントの有無が分かってしまう)
+    if not bcrypt.checkpw(plain_password.encode('utf-8'), hashed_password): return False
+    if len(cache) >= PASSWORD_VERIFY_CACHE_SIZE: cache.clear()
+    cache[cache_key] = True
+    return True
 
 def get_user_from_bq(user_id: str) -> Any | None:
     if not bq_client: return None
-    query = f"SELECT * FROM `{TABLE_USERS_FULL_ID}` WHERE user_id = @user_id"
+    query = f"SELECT password_hash FROM `{TABLE_USERS_FULL_ID}` WHERE user_id = @user_id LIMIT 1"
     job_config = bigquery.QueryJobConfig(query_parameters=[
         bigquery.ScalarQueryParameter("user_id", "STRING", user_id)
     ])
@@ -145,6 +244,30 @@ def get_user_from_bq(user_id: str) -> Any | None:
     except google.api_core.exceptions.NotFound:
         return None
 
+def get_bcrypt_cost(hashed_password: str) -> int | None:
+    # "$2b$12$..." 形式のハッシュからコスト値を取り出す
+    match = BCRYPT_COST_PATTERN.match(hashed_password)
+    return int(match.group(1)) if match else None
+
+def update_password_hash_in_bq(user_id: str, password: str) -> bool:
+    # バックグラウンドスレッドから呼ばれるため、st.* によるUI出力は行わない
+    if not bq_client: return False
+    query = f"UPDATE `{TABLE_USERS_FULL_ID}` SET password_hash = @password_hash WHERE user_id = @user_id"
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter("password_hash", "STRING", hash_password(password).decode('utf-8')),
+        bigquery.ScalarQueryParameter("user_id", "STRING", user_id),
+    ])
+    try:
+        bq_client.query(query, job_config=job_config).result()
+        return True
+    except Exception:
+        return False
+
+def rehash_password_if_needed(user_id: str, password: str, stored_hash: str):
+    # 旧コストのハッシュはログイン成功時に現在のコストで再ハッシュする (ログイン処理はブロックしない)
+    if get_bcrypt_cost(stored_hash) == BCRYPT_ROUNDS: return
+    get_background_executor().submit(update_password_hash_in_bq, user_id, password)
+
 def create_user_in_bq(user_id: str, password: str) -> bool:
     if not bq_client: return False
     if get_user_from_bq(user_id):
@@ -157,20 +280,30 @@ def create_user_in_bq(user_id: str, password: str) -> bool:
         "password_hash": hashed_password.decode('utf-8'),
         "created_at": datetime.now(timezone.utc).isoformat()
     }
-    errors = bq_client.insert_rows_json(TABLE_USERS_FULL_ID, [user_data])
+    # user_idを挿入IDにして、再試行や二重送信で同じユーザー行が重複しないようにする
+    errors = bq_client.insert_rows_json(TABLE_USERS_FULL_ID, [user_data], row_ids=[user_id], retry=BIGQUERY_INSERT_RETRY, skip_invalid_rows=False, ignore_unknown_values=True)
     return not errors
 
 # === 5. BigQuery 操作関数 ===
-def init_bigquery_table(table_full_id: str, schema: List[bigquery.SchemaField]):
+def init_bigquery_table(
+    table_full_id: str, schema: List[bigquery.SchemaField], clustering_fields: List[str] | None = None,
+    time_partitioning: bigquery.TimePartitioning | None = None
+):
     if not bq_client: return
+    # 存在確認済みのテーブルはプロセス内で記録し、リランごとのget_table呼び出しを省く
+    initialized_tables = get_initialized_tables()
+    if table_full_id in initialized_tables: return
     try:
         bq_client.get_table(table_full_id)
     except google.api_core.exceptions.NotFound:
         table_name = table_full_id.split('.')[-1]
         st.toast(f"BigQueryテーブル '{table_name}' を新規作成します。")
         table = bigquery.Table(table_full_id, schema=schema)
+        if clustering_fields: table.clustering_fields = clustering_fields
+        if time_partitioning: table.time_partitioning = time_partitioning
         bq_client.create_table(table)
         st.toast(f"テーブル '{table_name}' を作成しました。")
+    initialized_tables.add(table_full_id)
 
 def add_transaction_to_bq(user_id: str, transaction_data: Dict[str, Any]) -> bool:
     if not bq_client: return False
@@ -202,17 +335,44 @@ def add_transaction_to_bq(user_id: str, transaction_data: Dict[str, Any]) -> boo
         if query_job.errors:
             st.error(f"履歴の登録中にエラーが発生しました: {query_job.errors}")
             return False
+        get_transactions_from_bq.clear(user_id)
         return True
     except Exception as e:
         st.error(f"履歴の登録中に予期せぬエラーが発生しました: {e}")
         return False
 
+def add_transactions_bulk_to_bq(user_id: str, transactions: List[Dict[str, Any]]) -> bool:
+    # 複数件の登録はDMLを1件ずつ発行せず、1回のロードジョブ(無料・高速)でまとめて追記する
+    if not bq_client: return False
+    if not transactions: return True
+    rows = [
+        {
+            **transaction,
+            "transaction_id": str(uuid.uuid4()),
+            "user_id": user_id,
+            "transaction_date": transaction['transaction_date'].isoformat(),
+        }
+        for transaction in transactions
+    ]
+    job_config = bigquery.LoadJobConfig(
+        schema=BIGQUERY_SCHEMA_TRANSACTIONS,
+        write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+    )
+    try:
+        load_job = bq_client.load_table_from_json(rows, TABLE_TRANSACTIONS_FULL_ID, job_config=job_config)
+        load_job.result()
+        if load_job.errors:
+            st.error(f"履歴の一括登録中にエラーが発生しました: {load_job.errors}")
+            return False
+        get_transactions_from_bq.clear(user_id)
+        return True
+    except Exception as e:
+        st.error(f"履歴の一括登録中に予期せぬエラーが発生しました: {e}")
+        return False
+
 def delete_transaction_from_bq(user_id: str, transaction_id: str) -> bool:
     if not bq_client: return False
-    query = f"""
-    DELETE FROM `{TABLE_TRANSACTIONS_FULL_ID}`
-    WHERE user_id = @user_id AND transaction_id = @transaction_id
-    """
+    query = DELETE_TRANSACTION_SQL
     job_config = bigquery.QueryJobConfig(
         query_parameters=[
             bigquery.ScalarQueryParameter("user_id", "STRING", user_id),
@@ -221,6 +381,7 @@ def delete_transaction_from_bq(user_id: str, transaction_id: str) -> bool:
     )
     try:
         bq_client.query(query, job_config=job_config).result()
+        get_transactions_from_bq.clear(user_id)
         return True
     except Exception as e:
         st.error(f"履歴の削除中にエラーが発生しました: {e}")
@@ -228,18 +389,7 @@ def delete_transaction_from_bq(user_id: str, transaction_id: str) -> bool:
 
 def update_transaction_in_bq(user_id: str, transaction_id: str, updated_data: Dict[str, Any]) -> bool:
     if not bq_client: return False
-    query = f"""
-    UPDATE `{TABLE_TRANSACTIONS_FULL_ID}`
-    SET
-        transaction_date = @transaction_date,
-        exchange = @exchange,
-        quantity = @quantity,
-        price_jpy = @price_jpy,
-        fee_jpy = @fee_jpy,
-        total_jpy = @total_jpy
-    WHERE
-        user_id = @user_id AND transaction_id = @transaction_id
-    """
+    query = UPDATE_TRANSACTION_SQL
     job_config = bigquery.QueryJobConfig(
         query_parameters=[
             bigquery.ScalarQueryParameter("transaction_date", "TIMESTAMP", updated_data['transaction_date']),
@@ -258,61 +408,127 @@ def update_transaction_in_bq(user_id: str, transaction_id: str, updated_data: Di
         if query_job.errors:
             st.error(f"履歴の更新中にエラーが発生しました: {query_job.errors}")
             return False
+        get_transactions_from_bq.clear(user_id)
         return True
     except Exception as e:
         st.error(f"履歴の更新中に予期せぬエラーが発生しました: {e}")
         return False
 
+@st.cache_data(ttl=60, max_entries=256, show_spinner=False)
 def get_transactions_from_bq(user_id: str) -> pd.DataFrame:
     if not bq_client: return pd.DataFrame()
-    query = f"SELECT * FROM `{TABLE_TRANSACTIONS_FULL_ID}` WHERE user_id = @user_id ORDER BY transaction_date DESC"
+    query = f"SELECT {', '.join(TRANSACTION_SELECT_COLUMNS)} FROM `{TABLE_TRANSACTIONS_FULL_ID}` WHERE user_id = @user_id"
     job_config = bigquery.QueryJobConfig(
         query_parameters=[bigquery.ScalarQueryParameter("user_id", "STRING", user_id)]
     )
     try:
-        df = bq_client.query(query, job_config=job_config).to_dataframe(create_bqstorage_client=False)
-        if df.empty: return pd.DataFrame()
-        df = df.drop(columns=['user_id'], errors='ignore')
-        df['transaction_date'] = pd.to_datetime(df['transaction_date']).dt.tz_convert('Asia/Tokyo')
-        return df.rename(columns=COLUMN_NAME_MAP_JA)
+        # BigQuery Storage API (Arrow形式) で取得し、タイムゾーン変換もArrow上で済ませてからpandasに変換する
+        table = bq_client.query(query, job_config=job_config).to_arrow(create_bqstorage_client=True)
+        if table.num_rows == 0: return pd.DataFrame()
+        # 並べ替えはBigQuery側のソート段を使わず、受信後のArrowテーブル上で行う
+        table = table.sort_by([('transaction_date', 'descending')])
+        date_idx = table.schema.get_field_index('transaction_date')
+        table = table.set_column(date_idx, 'transaction_date', table.column(date_idx).cast(pa.timestamp('us', tz='Asia/Tokyo')))
+        # コイン・取引所・種別など値の種類が少ない列は辞書エンコードし、pandas側ではカテゴリ型として扱う
+        for name in TRANSACTION_CATEGORY_COLUMNS:
+            idx = table.schema.get_field_index(name)
+            table = table.set_column(idx, name, table.column(idx).dictionary_encode())
+        # 文字列列はPythonオブジェクトに展開せず、Arrowバッファのままpandasに渡す
+        return table.to_pandas(types_mapper={pa.string(): pd.StringDtype("pyarrow")}.get).rename(columns=COLUMN_NAME_MAP_JA)
     except google.api_core.exceptions.NotFound:
-        init_bigquery_table(TABLE_TRANSACTIONS_FULL_ID, BIGQUERY_SCHEMA_TRANSACTIONS)
+        get_initialized_tables().discard(TABLE_TRANSACTIONS_FULL_ID)
+        init_bigquery_table(TABLE_TRANSACTIONS_FULL_ID, BIGQUERY_SCHEMA_TRANSACTIONS, BIGQUERY_CLUSTERING_TRANSACTIONS, BIGQUERY_PARTITIONING_TRANSACTIONS)
         return pd.DataFrame()
 
-@st.cache_data(ttl=300)
+@st.cache_data(ttl=300, max_entries=256, show_spinner=False)
 def get_watchlist_from_bq(user_id: str) -> pd.DataFrame:
     if not bq_client: return pd.DataFrame()
-    query = f"SELECT coin_id, sort_order FROM `{TABLE_WATCHLIST_FULL_ID}` WHERE user_id = @user_id ORDER BY sort_order ASC"
+    # 件数が少ないため、BigQuery側のORDER BYは行わずpandasで並べ替える
+    query = f"SELECT coin_id, sort_order FROM `{TABLE_WATCHLIST_FULL_ID}` WHERE user_id = @user_id"
     job_config = bigquery.QueryJobConfig(query_parameters=[bigquery.ScalarQueryParameter("user_id", "STRING", user_id)])
     try:
-        return bq_client.query(query, job_config=job_config).to_dataframe(create_bqstorage_client=False)
+        df = bq_client.query(query, job_config=job_config).to_dataframe(create_bqstorage_client=False)
+        return df.sort_values('sort_order', kind='stable', ignore_index=True)
     except google.api_core.exceptions.NotFound:
+        get_initialized_tables().discard(TABLE_WATCHLIST_FULL_ID)
         init_bigquery_table(TABLE_WATCHLIST_FULL_ID, BIGQUERY_SCHEMA_WATCHLIST)
         return pd.DataFrame()
 
-def update_watchlist_in_bq(user_id: str, ordered_coin_ids: List[str]):
-    if not bq_client: return
+def update_watchlist_in_bq(user_id: str, ordered_coin_ids: List[str]) -> bool:
+    if not bq_client: return False
+    # 削除・並び替え・追加を1回のMERGEで行う (並び順は配列のオフセットをそのまま使う)
+    query = f"""
+    MERGE `{TABLE_WATCHLIST_FULL_ID}` T
+    USING (
+        SELECT @user_id AS user_id, coin_id, sort_order
+        FROM UNNEST(@coin_ids) AS coin_id WITH OFFSET AS sort_order
+    ) S
+    ON T.user_id = S.user_id AND T.coin_id = S.coin_id
+    WHEN MATCHED THEN
+        UPDATE SET sort_order = S.sort_order
+    WHEN NOT MATCHED THEN
+        INSERT (user_id, coin_id, sort_order, added_at) VALUES (S.user_id, S.coin_id, S.sort_order, CURRENT_TIMESTAMP())
+    WHEN NOT MATCHED BY SOURCE AND T.user_id = @user_id THEN
+        DELETE
+    """
     job_config = bigquery.QueryJobConfig(
-        query_parameters=[bigquery.ScalarQueryParameter("user_id", "STRING", user_id)]
+        query_parameters=[
+            bigquery.ScalarQueryParameter("user_id", "STRING", user_id),
+            bigquery.ArrayQueryParameter("coin_ids", "STRING", ordered_coin_ids),
+        ]
     )
-    delete_query = f"DELETE FROM `{TABLE_WATCHLIST_FULL_ID}` WHERE user_id = @user_id"
-    bq_client.query(delete_query, job_config=job_config).result()
-    if not ordered_coin_ids: return
-    rows_to_insert = [
-        {"user_id": user_id, "coin_id": coin_id, "sort_order": i, "added_at": datetime.now(timezone.utc).isoformat()}
-        for i, coin_id in enumerate(ordered_coin_ids)
-    ]
-    errors = bq_client.insert_rows_json(TABLE_WATCHLIST_FULL_ID, rows_to_insert)
-    if errors:
-        st.error(f"ウォッチリストの更新に失敗しました: {errors}")
+    try:
+        bq_client.query(query, job_config=job_config).result()
+    except Exception as e:
+        st.error(f"ウォッチリストの更新に失敗しました: {e}")
+        return False
+    get_watchlist_from_bq.clear(user_id)
+    get_watchlist_with_market_data.clear()
+    return True
 
 # === 6. API & データ処理関数 (変更なし) ===
-@st.cache_data(ttl=300)
+def api_cache_path(endpoint: str, params: Dict[str, Any]) -> str:
+    key = hashlib.md5(json.dumps([endpoint, params], sort_keys=True).encode('utf-8')).hexdigest()
+    return os.path.join(API_CACHE_DIR, f"coingecko_{key}.json")
+
+def read_api_cache(path: str, ttl: int) -> Any:
+    try:
+        with open(path, encoding='utf-8') as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return cached.get('payload') if time.time() - cached.get('ts', 0) < ttl else None
+
+def write_api_cache(path: str, payload: Any):
+    # 書き込み途中のファイルを他のプロセスが読まないよう、一時ファイルから置き換える
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        os.makedirs(API_CACHE_DIR, exist_ok=True)
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'ts': time.time(), 'payload': payload}, f)
+        os.replace(tmp_path, path)
+    except OSError:
+        pass
+
+def clear_api_cache():
+    try:
+        file_names = os.listdir(API_CACHE_DIR)
+    except OSError:
+        return
+    for file_name in file_names:
+        if file_name.startswith('coingecko_'):
+            try: os.remove(os.path.join(API_CACHE_DIR, file_name))
+            except OSError: pass
+
+@st.cache_data(ttl=MEMORY_CACHE_TTL_MARKETS)
 def get_full_market_data(currency='jpy') -> pd.DataFrame:
     try:
-        data = cg_client.get_coins_markets(
-            vs_currency=currency, order='market_cap_desc', per_page=250, page=1, sparkline=True
-        )
+        params = {'vs_currency': currency, 'order': 'market_cap_desc', 'per_page': 250, 'page': 1, 'sparkline': True}
+        cache_path = api_cache_path('coins/markets', params)
+        data = read_api_cache(cache_path, API_CACHE_TTL_MARKETS)
+        if data is None:
+            data = cg_client.get_coins_markets(**params)
+            write_api_cache(cache_path, data)
         df = pd.DataFrame(data)
         cols = ['id', 'symbol', 'name', 'image', 'current_price', 'price_change_percentage_24h', 'market_cap', 'sparkline_in_7d']
         df = df[[col for col in cols if col in df.columns]]
@@ -321,61 +537,70 @@ def get_full_market_data(currency='jpy') -> pd.DataFrame:
         st.error(f"市場価格データの取得に失敗しました: {e}")
         return pd.DataFrame()
 
-@st.cache_data(ttl=600)
+def fetch_bitcoin_prices(target_currency: str) -> Dict[str, Any]:
+    # バックグラウンドスレッドからも呼ばれるため、st.* によるUI出力は行わない (結果はディスクキャッシュに残る)
+    params = {'ids': 'bitcoin', 'vs_currencies': f'jpy,{target_currency.lower()}'}
+    cache_path = api_cache_path('simple/price', params)
+    prices = read_api_cache(cache_path, API_CACHE_TTL_PRICE)
+    if prices is None:
+        prices = cg_client.get_price(**params)
+        write_api_cache(cache_path, prices)
+    return prices
+
+@st.cache_data(ttl=MEMORY_CACHE_TTL_PRICE, max_entries=8)
 def get_exchange_rate(target_currency: str) -> float:
     if target_currency.lower() == 'jpy': return 1.0
     try:
-        prices = cg_client.get_price(ids='bitcoin', vs_currencies=f'jpy,{target_currency.lower()}')
+        prices = fetch_bitcoin_prices(target_currency)
         return prices['bitcoin'][target_currency.lower()] / prices['bitcoin']['jpy']
     except Exception as e:
         st.warning(f"{target_currency.upper()}の為替レート取得に失敗しました: {e}")
         return 1.0
 
-def calculate_portfolio(transactions_df: pd.DataFrame, market_data: pd.DataFrame) -> Tuple[Dict, float, float]:
-    price_map = market_data.set_index('id')['current_price'].to_dict()
-    yesterday_price_map = market_data.set_index('id').apply(
-        lambda row: row['current_price'] / (1 + row.get('price_change_percentage_24h', 0) / 100) if row.get('price_change_percentage_24h') is not None and (1 + row.get('price_change_percentage_24h', 0) / 100) != 0 else row['current_price'],
-        axis=1
-    ).to_dict()
-
-    portfolio, total_asset_jpy, total_change_24h_jpy = {}, 0.0, 0.0
+def calculate_portfolio(transactions_df: pd.DataFrame, market_data: pd.DataFrame) -> Tuple[pd.DataFrame, float, float]:
+    portfolio, total_asset_jpy, total_change_24h_jpy = pd.DataFrame(), 0.0, 0.0
     if transactions_df.empty: return portfolio, total_asset_jpy, total_change_24h_jpy
-    for (coin_id, exchange), group in transactions_df.groupby(['コインID', '取引所']):
-        buy_quantity = group[group['登録種別'].isin(TRANSACTION_TYPES_BUY)]['数量'].sum()
-        sell_quantity = group[group['登録種別'].isin(TRANSACTION_TYPES_SELL)]['数量'].sum()
-        current_quantity = buy_quantity - sell_quantity
-
-        if current_quantity > 1e-9:
-            price = price_map.get(coin_id, 0)
-            yesterday_price = yesterday_price_map.get(coin_id, price)
-            change_24h = price - yesterday_price
-            value = current_quantity * price
-            
-            try:
-                coin_name = market_data.set_index('id').at[coin_id, 'name']
-            except KeyError:
-                coin_name = coin_id
-
-            portfolio[(coin_id, exchange)] = {"コイン名": coin_name, "取引所": exchange, "保有数量": current_quantity, "現在価格(JPY)": price, "評価額(JPY)": value, "コインID": coin_id}
-            total_asset_jpy += value
-            total_change_24h_jpy += current_quantity * change_24h
+
+    market_indexed = market_data.set_index('id')
+    current_prices = market_indexed['current_price']
+    change_ratio = 1 + market_indexed['price_change_percentage_24h'] / 100
+    yesterday_prices = (current_prices / change_ratio).where(change_ratio.notna() & (change_ratio != 0), current_prices)
+
+    # 購入系を+、売却系を-とした数量を作り、(コイン, 取引所)単位で1回のgroupbyで集計する
+    # カテゴリ型の列ではmapの結果もカテゴリ型になりfillna(0.0)が失敗するため、float配列にしてから欠損を0にする
+    sign = np.nan_to_num(transactions_df['登録種別'].map(TRANSACTION_TYPE_SIGNS).to_numpy(dtype=float))
+    signed_quantity = pd.Series(transactions_df['数量'].to_numpy() * sign, index=transactions_df.index)
+    quantities = signed_quantity.groupby([transactions_df['コインID'], transactions_df['取引所']], sort=False, observed=True).sum()
+    quantities = quantities[quantities > 1e-9]
+    if quantities.empty: return portfolio, total_asset_jpy, total_change_24h_jpy
+
+    coin_ids = quantities.index.get_level_values(0)
+    current_quantities = quantities.to_numpy()
+    prices = current_prices.reindex(coin_ids).fillna(0).to_numpy()
+    yesterday = yesterday_prices.reindex(coin_ids).to_numpy()
+    yesterday = np.where(np.isnan(yesterday), prices, yesterday)
+    names = market_indexed['name'].reindex(coin_ids).to_numpy()
+    names = np.where(pd.isna(names), coin_ids.to_numpy(), names)
+    values = current_quantities * prices
+
+    # 保有明細は行ごとのdictを経由せず、列の配列から直接DataFrameを組み立てる
+    portfolio = pd.DataFrame({"コイン名": names, "取引所": quantities.index.get_level_values(1), "保有数量": current_quantities, "現在価格(JPY)": prices, "評価額(JPY)": values, "コインID": coin_ids})
+    total_asset_jpy = float(values.sum())
+    total_change_24h_jpy = float((current_quantities * (prices - yesterday)).sum())
     return portfolio, total_asset_jpy, total_change_24h_jpy
 
-def summarize_portfolio_by_coin(portfolio: Dict, market_data: pd.DataFrame) -> pd.DataFrame:
-    if not portfolio: return pd.DataFrame()
-    df = pd.DataFrame.from_dict(portfolio, orient='index').reset_index(drop=True)
-    summary = df.groupby('コインID').agg(コイン名=('コイン名', 'first'), 保有数量=('保有数量', 'sum'), 評価額_jpy=('評価額(JPY)', 'sum'), アカウント数=('取引所', 'nunique')).sort_values(by='評価額_jpy', ascending=False)
+def summarize_portfolio_by_coin(portfolio: pd.DataFrame, market_data: pd.DataFrame) -> pd.DataFrame:
+    if portfolio.empty: return pd.DataFrame()
+    summary = portfolio.groupby('コインID', observed=True).agg(コイン名=('コイン名', 'first'), 保有数量=('保有数量', 'sum'), 評価額_jpy=('評価額(JPY)', 'sum'), アカウント数=('取引所', 'nunique')).sort_values(by='評価額_jpy', ascending=False)
     market_subset = market_data[['id', 'symbol', 'name', 'price_change_percentage_24h', 'image']].rename(columns={'id': 'コインID'})
     summary = summary.reset_index().merge(market_subset, on='コインID', how='left')
     summary['price_change_percentage_24h'] = summary['price_change_percentage_24h'].fillna(0)
     summary.fillna({'symbol': '', 'image': '', 'name': ''}, inplace=True)
-    summary = summary[summary['保有数量'] > 1e-9]
     return summary
 
-def summarize_portfolio_by_exchange(portfolio: Dict) -> pd.DataFrame:
-    if not portfolio: return pd.DataFrame()
-    df = pd.DataFrame.from_dict(portfolio, orient='index').reset_index(drop=True)
-    summary = df.groupby('取引所').agg(
+def summarize_portfolio_by_exchange(portfolio: pd.DataFrame) -> pd.DataFrame:
+    if portfolio.empty: return pd.DataFrame()
+    summary = portfolio.groupby('取引所', observed=True).agg(
         評価額_jpy=('評価額(JPY)', 'sum'),
         コイン数=('コイン名', 'nunique')
     ).sort_values(by='評価額_jpy', ascending=False).reset_index()
@@ -387,6 +612,33 @@ def calculate_btc_value(total_asset_jpy: float, market_data: pd.DataFrame) -> fl
         return total_asset_jpy / btc_price_jpy if btc_price_jpy > 0 else 0.0
     except KeyError:
         return 0.0
+
+def market_data_key(market_data: pd.DataFrame) -> Tuple:
+    # DataFrame全体をハッシュせずに済むよう、銘柄構成と価格合計から軽量なキーを作る
+    if market_data.empty: return (0,)
+    return (len(market_data), market_data['id'].iat[0], market_data['id'].iat[-1], float(market_data['current_price'].sum()))
+
+@st.cache_data(ttl=600, max_entries=16, show_spinner=False)
+def get_portfolio_summary(transactions_df: pd.DataFrame, market_key: Tuple, _market_data: pd.DataFrame) -> Tuple[float, float, float, pd.DataFrame, pd.DataFrame]:
+    # 取引履歴の内容と市場データのキーが変わらない限り、通貨切替などの再実行では集計をやり直さない
+    portfolio, total_asset_jpy, total_change_jpy = calculate_portfolio(transactions_df, _market_data)
+    total_asset_btc = calculate_btc_value(total_asset_jpy, _market_data)
+    return total_asset_jpy, total_asset_btc, total_change_jpy, summarize_portfolio_by_coin(portfolio, _market_data), summarize_portfolio_by_exchange(portfolio)
+
+@st.cache_data(ttl=60, max_entries=256, show_spinner=False)
+def get_watchlist_with_market_data(user_id: str, market_key: Tuple, _market_data: pd.DataFrame) -> pd.DataFrame:
+    watchlist_db = get_watchlist_from_bq(user_id)
+    if watchlist_db.empty: return pd.DataFrame()
+    return watchlist_db.merge(_market_data, left_on='coin_id', right_on='id', how='left').dropna(subset=['id'])
+
+@st.cache_data(ttl=600)
+def get_coin_maps(market_key: Tuple, _market_data: pd.DataFrame) -> Tuple[Dict[str, str], Dict[str, str]]:
+    # 選択肢(id→表示名)とid→コイン名の辞書を、市場データが変わった時だけ1回の走査でまとめて作る
+    coin_options, name_map = {}, {}
+    for coin_id, name, symbol in zip(_market_data['id'].to_numpy(), _market_data['name'].to_numpy(), _market_data['symbol'].to_numpy()):
+        coin_options[coin_id] = f"{name} ({symbol.upper()})"
+        name_map[coin_id] = name
+    return coin_options, name_map
         
 # === 7. UIコンポーネント & ヘルパー関数 ===
 def format_price(price: float, symbol: str) -> str:
@@ -394,10 +646,13 @@ def format_price(price: float, symbol: str) -> str:
         formatted = f"{price:,.2f}"
     else:
         formatted = f"{price:,.8f}"
-    formatted = re.sub(r'\.0+$', '', formatted)
-    formatted = re.sub(r'(\.\d*?[1-9])0+$', r'\1', formatted)
+    formatted = ZERO_DECIMALS_PATTERN.sub('', formatted)
+    formatted = TRAILING_ZEROS_PATTERN.sub(r'\1', formatted)
     return f"{symbol}{formatted}"
 
+def format_quantity(quantity: float) -> str:
+    return f"{quantity:,.8f}".rstrip('0').rstrip('.')
+
 def format_market_cap(value: float, symbol: str) -> str:
     if symbol == '¥':
         if value >= 1_000_000_000_000: return f"{symbol}{value / 1_000_000_000_000:.2f}兆"
@@ -452,18 +707,21 @@ def display_asset_list_new(summary_df: pd.DataFrame, currency: str, rate: float)
         st.info("保有資産はありません。"); return
     
     symbol, is_hidden = CURRENCY_SYMBOLS[currency], st.session_state.get('balance_hidden', False)
-    for _, row in summary_df.iterrows():
+    # 通貨換算と単価計算は行ループに入る前に列単位でまとめて行う
+    values = summary_df['評価額_jpy'].to_numpy(dtype=float) * rate
+    quantities = summary_df['保有数量'].to_numpy(dtype=float)
+    unit_prices = np.divide(values, quantities, out=np.zeros_like(values), where=quantities > 0)
+    for row, value, price_per_unit in zip(summary_df.to_dict('records'), values, unit_prices):
         change_pct = row.get('price_change_percentage_24h', 0)
         is_positive = change_pct >= 0
         change_color, change_sign = ("#16B583", "▲") if is_positive else ("#FF5252", "▼")
         change_display, image_url = f"{abs(change_pct):.2f}%", row.get('image', '')
-        price_per_unit = (row['評価額_jpy'] / row['保有数量']) * rate if row['保有数量'] > 0 else 0
         
         if is_hidden:
             quantity_display, value_display, price_display = "*****", f"{symbol}*****", f"{symbol}*****"
         else:
-            quantity_display = f"{row['保有数量']:,.8f}".rstrip('0').rstrip('.')
-            value_display = f"{symbol}{row['評価額_jpy'] * rate:,.2f}"
+            quantity_display = format_quantity(row['保有数量'])
+            value_display = f"{symbol}{value:,.2f}"
             price_display = f"{symbol}{price_per_unit:,.2f}"
         
         card_html = f"""
@@ -491,8 +749,9 @@ def display_exchange_list(summary_exchange_df: pd.DataFrame, currency: str, rate
     if summary_exchange_df.empty:
         st.info("保有資産はありません。"); return
 
-    for _, row in summary_exchange_df.iterrows():
-        value_display = f"{symbol}*****" if is_hidden else f"{symbol}{row['評価額_jpy'] * rate:,.2f}"
+    values = summary_exchange_df['評価額_jpy'].to_numpy(dtype=float) * rate
+    for row, value in zip(summary_exchange_df.to_dict('records'), values):
+        value_display = f"{symbol}*****" if is_hidden else f"{symbol}{value:,.2f}"
         card_html = f"""
         <div style="background-color: #1E1E1E; border: 1px solid #444444; border-radius: 10px; padding: 15px 20px; margin-bottom: 12px;">
             <div style="display: flex; justify-content: space-between; align-items: center;">
@@ -508,8 +767,7 @@ def display_exchange_list(summary_exchange_df: pd.DataFrame, currency: str, rate
 
 def display_add_transaction_form(user_id: str, market_data: pd.DataFrame, currency: str):
     with st.expander("新しい取引履歴を追加", expanded=False):
-        coin_options = {row['id']: f"{row['name']} ({row['symbol'].upper()})" for _, row in market_data.iterrows()}
-        name_map = market_data.set_index('id')['name'].to_dict()
+        coin_options, name_map = get_coin_maps(market_data_key(market_data), market_data)
         with st.form(key=f"transaction_form_{currency}", clear_on_submit=True):
             st.subheader("履歴の登録")
             c1, c2, c3 = st.columns(3)
@@ -524,25 +782,62 @@ def display_add_transaction_form(user_id: str, market_data: pd.DataFrame, curren
                 price = st.number_input("価格 (JPY)", min_value=0.0, format="%.2f", key=f"price_{currency}")
                 fee = st.number_input("手数料 (JPY)", min_value=0.0, format="%.2f", key=f"fee_{currency}")
             
-            if st.form_submit_button("この内容で登録する"):
+            btn_cols = st.columns(2)
+            with btn_cols[0]:
+                submitted = st.form_submit_button("この内容で登録する")
+            with btn_cols[1]:
+                queued = st.form_submit_button("一時リストに追加", type="secondary")
+            if submitted or queued:
                 transaction = {
-                    "transaction_date": datetime.combine(date, datetime.min.time()),
+                    "transaction_date": datetime.combine(date, MIDNIGHT),
                     "coin_id": coin_disp, "coin_name": name_map.get(coin_disp, coin_disp),
                     "exchange": exchange, "transaction_type": trans_type, "quantity": quantity,
                     "price_jpy": price, "fee_jpy": fee, "total_jpy": quantity * price
                 }
+            if submitted:
                 if add_transaction_to_bq(user_id, transaction):
                     st.success(f"{transaction['coin_name']}の{trans_type}履歴を登録しました。")
                     st.rerun()
+            elif queued:
+                st.session_state.pending_transactions.append(transaction)
+                if len(st.session_state.pending_transactions) >= PENDING_TRANSACTIONS_FLUSH_SIZE:
+                    flush_pending_transactions(user_id)
+
+        # --- 一時リスト (まとめて1回のロードジョブで登録) ---
+        pending = st.session_state.pending_transactions
+        if pending:
+            st.caption(f"一時リスト: {len(pending)} 件 (未登録)")
+            pending_cols = st.columns(2)
+            with pending_cols[0]:
+                if st.button("一時リストをまとめて登録", key=f"flush_pending_{currency}", use_container_width=True):
+                    flush_pending_transactions(user_id)
+            with pending_cols[1]:
+                if st.button("一時リストを破棄", key=f"discard_pending_{currency}", use_container_width=True):
+                    st.session_state.pending_transactions = []
+                    st.rerun()
+
+def flush_pending_transactions(user_id: str):
+    pending = st.session_state.pending_transactions
+    if add_transactions_bulk_to_bq(user_id, pending):
+        st.toast(f"{len(pending)} 件の履歴を登録しました。", icon="✅")
+        st.session_state.pending_transactions = []
+        st.rerun()
 
 # ★★★ 履歴表示＆編集機能の全体を修正 ★★★
+@st.fragment
 def display_transaction_history(user_id: str, transactions_df: pd.DataFrame):
     st.subheader("🗒️ 登録履歴一覧")
     if transactions_df.empty:
         st.info("まだ登録履歴がありません。")
         return
     
-    for index, row in transactions_df.iterrows():
+    # ページ単位で表示し、1回の描画で生成するウィジェット数を抑える
+    total_pages = (len(transactions_df) - 1) // TRANSACTION_HISTORY_PAGE_SIZE + 1
+    page = min(st.session_state.get('tx_page', 0), total_pages - 1)
+    start = page * TRANSACTION_HISTORY_PAGE_SIZE
+    page_df = transactions_df.iloc[start:start + TRANSACTION_HISTORY_PAGE_SIZE]
+
+    for row in page_df.to_dict('records'):
         transaction_id = row['取引ID']
         
         # 編集モードかどうかをチェック
@@ -565,7 +860,7 @@ def display_transaction_history(user_id: str, transactions_df: pd.DataFrame):
                 with btn_cols[0]:
                     if st.form_submit_button("保存する", use_container_width=True):
                         updated_data = {
-                            "transaction_date": datetime.combine(edit_date, datetime.min.time()),
+                            "transaction_date": datetime.combine(edit_date, MIDNIGHT),
                             "exchange": edit_exchange,
                             "quantity": edit_quantity,
                             "price_jpy": edit_price,
@@ -587,7 +882,7 @@ def display_transaction_history(user_id: str, transactions_df: pd.DataFrame):
                 with cols[0]:
                     st.markdown(f"**{row['コイン名']}** - {row['登録種別']}")
                     st.caption(f"{row['登録日'].strftime('%Y/%m/%d')} | {row['取引所']}")
-                    st.text(f"数量: {row['数量']:.8f}".rstrip('0').rstrip('.'))
+                    st.text(f"数量: {format_quantity(row['数量'])}")
                 with cols[1]:
                     if st.button("編集 ✏️", key=f"edit_{transaction_id}", use_container_width=True):
                         st.session_state.editing_transaction_id = transaction_id
@@ -598,14 +893,28 @@ def display_transaction_history(user_id: str, transactions_df: pd.DataFrame):
                             st.toast(f"履歴を削除しました。", icon="🗑️")
                             st.rerun()
 
+    if total_pages > 1:
+        nav_cols = st.columns([1, 2, 1])
+        with nav_cols[0]:
+            if st.button("◀ 前へ", key="tx_page_prev", disabled=page == 0, use_container_width=True):
+                st.session_state.tx_page = page - 1
+                st.rerun(scope="fragment")
+        with nav_cols[1]:
+            st.caption(f"{page + 1} / {total_pages} ページ ({len(transactions_df)} 件)")
+        with nav_cols[2]:
+            if st.button("次へ ▶", key="tx_page_next", disabled=page >= total_pages - 1, use_container_width=True):
+                st.session_state.tx_page = page + 1
+                st.rerun(scope="fragment")
+
 # === 8. ページ描画関数 ===
-def render_portfolio_page(user_id: str, jpy_market_data: pd.DataFrame, currency: str, rate: float):
+@st.fragment
+def render_portfolio_page(user_id: str, jpy_market_data: pd.DataFrame):
+    # 通貨・表示切替はこのフラグメント内だけで再実行するため、通貨とレートはここで決める
+    currency = st.session_state.currency
+    rate = get_exchange_rate('usd') if currency == 'usd' else 1.0
     transactions_df = get_transactions_from_bq(user_id)
     
-    portfolio, total_asset_jpy, total_change_jpy = calculate_portfolio(transactions_df, jpy_market_data)
-    total_asset_btc = calculate_btc_value(total_asset_jpy, jpy_market_data)
-    summary_df = summarize_portfolio_by_coin(portfolio, jpy_market_data)
-    summary_exchange_df = summarize_portfolio_by_exchange(portfolio)
+    total_asset_jpy, total_asset_btc, total_change_jpy, summary_df, summary_exchange_df = get_portfolio_summary(transactions_df, market_data_key(jpy_market_data), jpy_market_data)
     
     col1, col2 = st.columns([0.9, 0.1])
     with col1: 
@@ -614,16 +923,20 @@ def render_portfolio_page(user_id: str, jpy_market_data: pd.DataFrame, currency:
         st.markdown("<div style='margin-top: 30px;'></div>", unsafe_allow_html=True)
         if st.button("👁️", key=f"toggle_visibility_{currency}", help="残高の表示/非表示", use_container_width=True):
             st.session_state.balance_hidden = not st.session_state.get('balance_hidden', False)
-            st.rerun()
+            st.rerun(scope="fragment")
         
         button_label, new_currency = (CURRENCY_SYMBOLS['usd'], "usd") if currency == 'jpy' else (CURRENCY_SYMBOLS['jpy'], "jpy")
 
         if st.button(button_label, key=f"currency_toggle_main_{currency}", help=f"{new_currency.upper()}表示に切り替え", use_container_width=True):
             st.session_state.currency = new_currency
-            st.rerun()
+            st.query_params['ccy'] = new_currency
+            st.rerun(scope="fragment")
 
         if st.button("🔄", key=f"refresh_data_{currency}", help="市場価格を更新", use_container_width=True):
-            st.cache_data.clear()
+            # 市場データ関連のキャッシュのみ破棄 (取引履歴・ウォッチリストのキャッシュは維持)
+            get_full_market_data.clear()
+            get_exchange_rate.clear()
+            clear_api_cache()
             st.rerun()
             
     st.divider()
@@ -637,7 +950,7 @@ def render_portfolio_page(user_id: str, jpy_market_data: pd.DataFrame, currency:
         display_transaction_history(user_id, transactions_df)
         display_add_transaction_form(user_id, jpy_market_data, currency)
 
-def render_watchlist_row(row_data: pd.Series, currency: str, rate: float, rank: str = " "):
+def render_watchlist_row(row_data: pd.Series | Dict[str, Any], currency: str, rate: float, rank: str = " "):
     currency_symbol = CURRENCY_SYMBOLS.get(currency, '$')
     is_positive = row_data.get('price_change_percentage_24h', 0) >= 0
     change_color, change_icon = ("#16B583", "▲") if is_positive else ("#FF5252", "▼")
@@ -672,15 +985,16 @@ def render_market_cap_watchlist(market_data: pd.DataFrame, currency: str, rate:
     if market_data.empty:
         st.warning("データが取得できませんでした。"); return
     
-    for index, row in market_data.head(100).iterrows():
-        render_watchlist_row(row, currency, rate, rank=str(index + 1))
+    records = market_data.head(MARKET_CAP_RANK_LIMIT).to_dict('records')
+    for rank, row in zip(MARKET_CAP_RANKS, records):
+        render_watchlist_row(row, currency, rate, rank=rank)
 
 def render_custom_watchlist(user_id: str, market_data: pd.DataFrame, currency: str, rate: float):
     watchlist_db = get_watchlist_from_bq(user_id)
     
     if not watchlist_db.empty:
-        watchlist_df = watchlist_db.merge(market_data, left_on='coin_id', right_on='id', how='left').dropna(subset=['id'])
-        for _, row in watchlist_df.iterrows():
+        watchlist_df = get_watchlist_with_market_data(user_id, market_data_key(market_data), market_data)
+        for row in watchlist_df.to_dict('records'):
             render_watchlist_row(row, currency, rate)
     else:
         st.info("カスタムウォッチリストは空です。下の編集エリアから銘柄を追加してください。")
@@ -691,7 +1005,7 @@ def render_custom_watchlist(user_id: str, market_data: pd.DataFrame, currency: s
         st.info("銘柄の追加・削除が可能です。リストの順番は選択した順になります。")
         
         current_list_ids = watchlist_db['coin_id'].tolist() if not watchlist_db.empty else []
-        all_coins_options = {row['id']: f"{row['name']} ({row['symbol'].upper()})" for _, row in market_data.iterrows()}
+        all_coins_options, _ = get_coin_maps(market_data_key(market_data), market_data)
         
         selected_coins = st.multiselect(
             "銘柄リスト",
@@ -702,11 +1016,11 @@ def render_custom_watchlist(user_id: str, market_data: pd.DataFrame, currency: s
         )
         
         if st.button("この内容でウォッチリストを保存"):
-            update_watchlist_in_bq(user_id, selected_coins)
-            st.toast("ウォッチリストを更新しました。")
-            st.cache_data.clear()
-            st.rerun()
+            if update_watchlist_in_bq(user_id, selected_coins):
+                st.toast("ウォッチリストを更新しました。")
+                st.rerun()
 
+@st.fragment
 def render_watchlist_page(user_id: str, jpy_market_data: pd.DataFrame):
     _, col_btn = st.columns([0.9, 0.1])
     with col_btn:
@@ -715,7 +1029,8 @@ def render_watchlist_page(user_id: str, jpy_market_data: pd.DataFrame):
 
         if st.button(button_label, key="currency_toggle_watchlist", use_container_width=True, help=f"{new_currency.upper()}表示に切り替え"):
             st.session_state.watchlist_currency = new_currency
-            st.rerun()
+            # 通貨切替はウォッチリストの表示だけに影響するため、ポートフォリオ側は再描画しない
+            st.rerun(scope="fragment")
 
     rate = get_exchange_rate(vs_currency) if vs_currency == 'usd' else 1.0
     
@@ -743,7 +1058,11 @@ def render_auth_page():
                     st.warning("ユーザーIDとパスワードを入力してください。")
                     return
                 user_data = get_user_from_bq(user_id)
-                if user_data and verify_password(password, user_data['password_hash'].encode('utf-8')):
+                # 存在しないユーザーでもダミーハッシュで照合し、応答時間からユーザーの有無を推測させない
+                # (ダミーの照合は全ユーザーIDで共通のため、verify_passwordのキャッシュを通さず毎回bcryptを回す)
+                if not user_data: bcrypt.checkpw(password.encode('utf-8'), get_dummy_password_hash())
+                if user_data and verify_password(user_id, password, user_data['password_hash'].encode('utf-8')):
+                    rehash_password_if_needed(user_id, password, user_data['password_hash'])
                     st.session_state.authenticated = True
                     st.session_state.user_id = user_id
                     st.toast("ログインしました！", icon="🎉")
@@ -761,6 +1080,8 @@ def render_auth_page():
             if submitted:
                 if not new_user_id or not new_password:
                     st.warning("ユーザーIDとパスワードを入力してください。")
+                elif not USER_ID_PATTERN.fullmatch(new_user_id):
+                    st.warning("ユーザーIDは3文字以上で、英数字・メールアドレスで使える記号(. _ + - @)のみ使用できます。")
                 elif new_password != confirm_password:
                     st.error("パスワードが一致しません。")
                 elif len(new_password) < 8:
@@ -776,14 +1097,17 @@ def main():
     st.session_state.setdefault('authenticated', False)
     st.session_state.setdefault('user_id', None)
     st.session_state.setdefault('balance_hidden', False)
-    st.session_state.setdefault('currency', 'jpy')
+    # 表示通貨はURLのクエリパラメータ(ccy)から復元し、リロードや共有URLでも維持する
+    st.session_state.setdefault('currency', st.query_params.get('ccy') if st.query_params.get('ccy') in CURRENCY_SYMBOLS else 'jpy')
     st.session_state.setdefault('watchlist_currency', 'jpy')
     st.session_state.setdefault('editing_transaction_id', None) # ★編集モード管理用
+    st.session_state.setdefault('tx_page', 0)
+    st.session_state.setdefault('pending_transactions', [])
     
     if not bq_client: st.stop()
     
     if not st.session_state.authenticated:
-        init_bigquery_table(TABLE_USERS_FULL_ID, BIGQUERY_SCHEMA_USERS)
+        init_bigquery_table(TABLE_USERS_FULL_ID, BIGQUERY_SCHEMA_USERS, BIGQUERY_CLUSTERING_USERS)
         render_auth_page()
         st.stop()
 
@@ -799,24 +1123,25 @@ def main():
         st.write("表示設定")
 
     try:
-        init_bigquery_table(TABLE_TRANSACTIONS_FULL_ID, BIGQUERY_SCHEMA_TRANSACTIONS)
+        init_bigquery_table(TABLE_TRANSACTIONS_FULL_ID, BIGQUERY_SCHEMA_TRANSACTIONS, BIGQUERY_CLUSTERING_TRANSACTIONS, BIGQUERY_PARTITIONING_TRANSACTIONS)
         init_bigquery_table(TABLE_WATCHLIST_FULL_ID, BIGQUERY_SCHEMA_WATCHLIST)
     except Exception as e:
         st.error(f"データベースの初期化中にエラーが発生しました: {e}")
         st.stop()
 
+    # USD表示がある場合は、BTC価格の取得を市場データと並行して行いディスクキャッシュに載せておく
+    # (ワーカースレッドではst.*を呼ばず、為替レートの計算・警告表示はメインスレッドのget_exchange_rateで行う)
+    needs_usd_rate = 'usd' in (st.session_state.currency, st.session_state.watchlist_currency)
+    rate_future = get_background_executor().submit(fetch_bitcoin_prices, 'usd') if needs_usd_rate else None
     jpy_market_data = get_full_market_data(currency='jpy')
     if jpy_market_data.empty:
         st.error("市場データを取得できませんでした。"); st.stop()
+    if rate_future: rate_future.exception() # 完了を待つだけ (失敗時はget_exchange_rateが再取得して警告する)
     
-    usd_rate = get_exchange_rate('usd')
-
     portfolio_tab, watchlist_tab = st.tabs(["ポートフォリオ", "ウォッチリスト"])
 
     with portfolio_tab:
-        current_currency = st.session_state.currency
-        current_rate = usd_rate if current_currency == 'usd' else 1.0
-        render_portfolio_page(user_id, jpy_market_data, currency=current_currency, rate=current_rate)
+        render_portfolio_page(user_id, jpy_market_data)
 
     with watchlist_tab:
         render_watchlist_page(user_id, jpy_market_data)